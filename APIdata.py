@@ -17,20 +17,96 @@ import pandas as pd
 
 import requests
 
-import ast
+from requests.adapters import HTTPAdapter
 
-from pyjstat import pyjstat
+import json
 
-from collections import OrderedDict
+import numpy as np
 
 from ipywidgets import widgets
 
 from IPython.display import display
 
-# todo: consider using jsonstat instead of pyjstat
+# todo: make converter part of the default specification only for statistics norway
+_SSB_ENCODE_TABLE = str.maketrans({'æ' : '%C3%A6', 'Æ' : '%C3%86', 'ø' : '%C3%B8', 'Ø' : '%C3%98', 'å' : '%C3%A5', 'Å' : '%C3%85',
+                                   '"' : '%22', '(' : '%28', ')' : '%29', ' ' : '%20'})
+
+_SEARCH_URL = '{base_url}/{language}/table/?query={phrase}'
+
+_TABLE_URL = '{base_url}/{language}/table/{table_id}'
+
+
+def _from_json_stat(dataset):
+    """
+    Turns a json-stat dataset into a pandas dataframe with one column for
+    each dimension (named by the dimension label) and a 'value' column.
+
+    The values are a flat array in row-major order of the dimensions,
+    so they only have to be reshaped against the dimension sizes.
+    """
+
+    dimension = dataset['dimension']
+    sizes = dimension['size']
+
+    names = []
+    labels = []
+    for dim in dimension['id']:
+        category = dimension[dim]['category']
+        index = category.get('index', list(category['label']))
+        if isinstance(index, dict):
+            index = sorted(index, key=index.get)
+        names.append(dimension[dim]['label'])
+        labels.append([category['label'].get(code, code) for code in index])
+
+    values = np.asarray(dataset['value'], dtype=np.float64).reshape(sizes)
+    idx = pd.MultiIndex.from_product(labels, names=names)
+
+    return pd.DataFrame({'value': values.ravel()}, index=idx).reset_index()
+
+
+# parsers for the time column of SSB tables, one for each time marker
+
+def _parse_monthly(dates):
+    # '2018M03' -> 2018-03-01
+    return pd.to_datetime(dates, format='%YM%m')
+
+
+def _parse_weekly(dates):
+    # '2018U05' -> monday of week 5
+    return pd.to_datetime(dates + '-1', format='%YU%W-%w')
+
+
+def _parse_quarterly(dates):
+    """
+    Vectorized version of API_to_data.fiksDato: turns quarters like '2018K3'
+    into the last day of the quarter (2018-09-30).
+    """
+
+    # build the dates from integer parts, no intermediate date strings
+    parts = pd.DataFrame({'year': dates.str[:4].astype('int16'),
+                          'month': dates.str[5:].astype('int8') * 3,
+                          'day': 1})
+
+    return pd.to_datetime(parts) + pd.offsets.MonthEnd(0)
+
+
+def _parse_yearly(dates):
+    # '2018' -> 2018-01-01
+    return pd.to_datetime(dates)
+
 
 class API_to_data:
 
+    # (language, time marker) -> (time column label, parser, freq, periods)
+    _TIME_SPEC = {('no', 'M'): ('måned', _parse_monthly, 'M', 12),
+                  ('no', 'U'): ('uke', _parse_weekly, 'W', 52),
+                  ('no', 'K'): ('kvartal', _parse_quarterly, 'q', 4),
+                  ('no', 'Y'): ('år', _parse_yearly, 'y', 1),
+                  ('en', 'M'): ('month', _parse_monthly, 'M', 12),
+                  ('en', 'U'): ('week', _parse_weekly, 'W', 52),
+                  ('en', 'K'): ('quarter', _parse_quarterly, 'q', 4),
+                  ('en', 'Y'): ('year', _parse_yearly, 'y', 1)}
+
     def __init__(self, language='en', base_url='http://data.ssb.no/api/v0'):
 
         """
@@ -54,6 +130,24 @@ class API_to_data:
         self.furl = None
         self.variables = None
         self.time = None
+        self._table_info = None
+        self._cache = {}
+
+        # one session for all requests, so the connection to the api is reused
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=10)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def _fetch_json(self, url):
+        """
+        Downloads url and returns the parsed json content.
+        """
+
+        response = self._session.get(url, timeout=30)
+        response.raise_for_status()
+
+        return response.json()
 
     def search(self, phrase):
         """
@@ -80,16 +174,10 @@ class API_to_data:
 
             """
 
-        # todo: make converter part of the default specification only for statistics norway
-        convert = {'æ' : '%C3%A6', 'Æ' : '%C3%86', 'ø' : '%C3%B8', 'Ø' : '%C3%98', 'å' : '%C3%A5', 'Å' : '%C3%85',
-                   '"' : '%22', '(' : '%28', ')' : '%29', ' ' : '%20'}
-
-        search_str = '{base_url}/{language}/table/?query={phrase}'.format(base_url=self.burl, language=self.language, phrase=phrase)
-
-        for k, v in convert.items():
-            search_str = search_str.replace(k, v)
+        search_str = _SEARCH_URL.format(base_url=self.burl, language=self.language,
+                                        phrase=phrase.translate(_SSB_ENCODE_TABLE))
 
-        df = pd.read_json(search_str)
+        df = pd.DataFrame(self._fetch_json(search_str))
 
         if len(df) == 0:
             print("No match")
@@ -101,17 +189,15 @@ class API_to_data:
 
         # split the table name into table id and table text
 
-        df['table_id'] = df['title'].str.split(':').str.get(0)
-        df['table_title'] = df['title'].str.split(':').str.get(1)
+        # (split on the first colon only, colons in the table text are kept)
+        df[['table_id', 'table_title']] = df['title'].str.split(':', n=1, expand=True)
         del df['title']
 
         # make table_id the index, visually more intuitive with id as first column
         df = df.set_index('table_id')
 
-        # change order of columns to make it more intuitive (table_title is first) 
-        cols = df.columns.tolist()
-        cols.sort(reverse=True)
-        df = df[cols[:-2]]
+        # keep the informative columns, in an intuitive order (table_title is first)
+        df = df.reindex(columns=['table_title', 'score', 'published'])
 
         return df
 
@@ -133,19 +219,19 @@ class API_to_data:
 
         """
         try:
-            numb = int(table_id)
-            if len(str(numb)) == 4:
-                numb = '0' + str(numb)
+            numb = '{:05d}'.format(int(table_id))
 
         except ValueError:
-            print('table_id mus be of type integer')
+            raise ValueError('table_id must be integer-valued')
 
-        if self.furl is None:
-            self.furl = '{base_url}/{language}/table/{table_id}'.format(base_url=self.burl, language=self.language,
-                                                                             table_id=numb)
+        self.furl = _TABLE_URL.format(base_url=self.burl, language=self.language, table_id=numb)
 
-        df = pd.read_json(self.furl)
-        variables = [dict(values) for values in df.iloc[:, 1]]
+        # reuse table metadata already downloaded for this url
+        if self.furl not in self._cache:
+            self._cache[self.furl] = self._fetch_json(self.furl)
+
+        self._table_info = self._cache[self.furl]
+        variables = self._table_info['variables']
 
         return variables
 
@@ -170,29 +256,25 @@ class API_to_data:
         # get a list with dictionaries containing information about each variable
         self.variables = self.get_variables(table_id=table_id)
 
-        table_info = pd.read_json(self.furl)
-        table_title = table_info.iloc[0, 0]
+        table_title = self._table_info['title']
 
         # get number of variables (ok, childish approach, can be simplified!)
         nvars = len(self.variables)
         var_list = list(range(nvars))
 
-        # a list of dictionaries of the values available for each variable
-        option_list = [OrderedDict(zip(self.variables[var]['valueTexts'],
-                                       self.variables[var]['values']))
-                       for var in var_list]
-
-        # create a selection widget for each variable
+        # create a selection widget for each variable, with the values available for it
         # todo: skip widget or make it invisible if there is only one option?
         # todo: make first alternative a default selection initially for all tables?
         # todo: add buttons for selecting "all", "latest" , "first" and "none"
 
-        selection_widgets = [widgets.widget_selection.SelectMultiple(
-                                options=option_list[var],
+        SelectMultiple = widgets.widget_selection.SelectMultiple
+        selection_widgets = []
+        for variable in self.variables:
+            selection_widgets.append(SelectMultiple(
+                                options=dict(zip(variable['valueTexts'], variable['values'])),
                                 rows=8,
                                 layout={'width' : '500px'}
-                                )
-                             for var in var_list]
+                                ))
 
         # put all the widgets in a container
         variables_container = widgets.Tab(selection_widgets)
@@ -254,36 +336,23 @@ class API_to_data:
 
         """
 
-        table_url = box.children[3].value
-        nvars = len(box.children[2].children)
-        var_list = list(range(nvars))
-        query_element = {}
-
-        # create a dict of strings, one for each variable that specifies 
+        # one element for each variable that specifies
         # the json-stat that selects the variables/values
+        query_element = [{"code": variable['code'],
+                          "selection": {"filter": "item",
+                                        "values": list(tab.value)}}
+                         for variable, tab in zip(self.variables, box.children[2].children)]
 
-        for x in var_list:
-            value_list = str(list(box.children[2].children[x].value))
-            query_element[x] = '{{"code": "{code}", "selection": {{"filter": "item", "values": {values} }}}}'.format(
-                code = self.variables[x]['code'],
-                values = value_list)
-            query_element[x] = query_element[x].replace("\'", '"')
-
-        all_elements = str(list(query_element.values()))
-        all_elements = all_elements.replace("\'", "")
+        query = {"query": query_element, "response": {"format": "json-stat"}}
 
-        query = '{{"query": {all_elements} , "response": {{"format": "json-stat" }}}}'.format(all_elements = all_elements)
+        if out == 'str':
+            query = json.dumps(query)
 
-        if out == 'dict':
-            query = ast.literal_eval(query)
-
-        # todo: build it as a dictionary to start with (and not a string that is made into a dict as now)
         # todo: add error message if required variables are not selected
-        # todo: avoid repeat downloading of same information 
-        # eg. get_variables is sometimes used three times before a table is downloaded
 
         return query
 
+    @staticmethod
     def to_dict(json_str):
         """
         Transforms a string to a dictionary.
@@ -292,8 +361,7 @@ class API_to_data:
         """
 
         # OK, really unnecessary func, but a concession to less experienced users
-        # todo: use json module instead, json.dumps()
-        query = ast.literal_eval(json_str)
+        query = json.loads(json_str)
         return query
 
     def read_box(self, from_box):
@@ -312,18 +380,23 @@ class API_to_data:
         from_box: widget container
 
         """
+        # check the selections before calling the api, network and json
+        # errors are left to the caller
         try:
+            selections = [tab.value for tab in from_box.children[2].children]
+        except (AttributeError, IndexError):
+            raise ValueError('from_box must be a widget container made by select()')
+
+        if not selections or not all(selections):
+            raise ValueError('You must make choices in the box!')
 
-            query = self.get_json(from_box)
-            url = from_box.children[3].value
-            data = requests.post(url, json=query)
-            results = pyjstat.from_json_stat(data.json(object_pairs_hook=OrderedDict))
-            label = data.json(object_pairs_hook=OrderedDict)
-            return [results[0], label['dataset']['label']]
-        except TypeError:
-            print('You must make choices in the box!')
-        except:
-            print('You must make choices in the box!')
+        query = self.get_json(from_box)
+        url = from_box.children[3].value
+        data = self._session.post(url, json=query, timeout=30)
+        data.raise_for_status()
+        dataset = data.json()['dataset']
+
+        return [_from_json_stat(dataset), dataset['label']]
 
     def fiksDato(self, dato):
         hjdat = int(dato[5:6]) * 3
@@ -353,66 +426,13 @@ class API_to_data:
 
         """
 
-        self.time = time_col = df.columns[-2]
-
-        if self.language == 'no':
-            df_ret = df[[self.time, val_col]]
-
-            if 'M' in df_ret.loc[0, self.time]:
-                self.time = 'måned'
-                df_ret = df[[self.time, val_col]]
-                df_ret.loc[:, self.time] = pd.to_datetime(df[self.time].str.replace('M', '-'))
-                freq = 'M';
-                periods = 12;
-            elif 'U' in df_ret.loc[0, self.time]:
-                self.time = 'uke'
-                df_ret = df[[self.time, val_col]] 
-                df_ret.loc[:, self.time] = pd.to_datetime((df[self.time].str.replace('U', '-')).add('-1'), format='%Y-%W-%w')
-                freq = 'W'
-                periods = 52
-            elif 'K' in df_ret.loc[0, self.time]:
-                self.time = 'kvartal'
-                df_ret = df[[self.time, val_col]]
-                df_ret.loc[:, self.time] = pd.to_datetime(df[self.time].str.replace('K', '-'))
-                df_ret.loc[:, self.time] = df[self.time].apply(self.fiksDato)
-                freq = 'q'
-                periods = 4
-            else:
-                self.time = 'år'
-                df_ret = df[[self.time, val_col]]
-                df_ret.loc[:, self.time] = pd.to_datetime(df[self.time])
-                freq = 'y'
-                periods = 1
-        elif self.language == 'en':
-            df_ret = df[[self.time, val_col]]
-
-            if 'M' in df_ret.loc[0, self.time]:
-                self.time = 'month'
-                df_ret = df[[self.time, val_col]]
-                df_ret.loc[:, self.time] = pd.to_datetime(df[self.time].str.replace('M', '-'))
-                freq = 'M'
-                periods = 12
-            elif 'U' in df_ret.loc[0, self.time]:
-                self.time = 'week'
-                df_ret = df[[self.time, val_col]] 
-                df_ret.loc[:, self.time] = pd.to_datetime((df[self.time].str.replace('U', '-')).add('-1'), format='%Y-%W-%w')
-                freq = 'W'
-                periods = 52
-            elif 'K' in df_ret.loc[0, self.time]:
-                self.time = 'quarter'
-                df_ret = df[[self.time, val_col]]
-                df_ret.loc[:, self.time] = pd.to_datetime(df[self.time].str.replace('K', '-'))
-                df_ret.loc[:, self.time] = df[self.time].apply(self.fiksDato)
-                freq = 'q'
-                periods = 4
-            else:
-                self.time = 'year'
-                df_ret = df[[self.time, val_col]]
-                df_ret.loc[:, self.time] = pd.to_datetime(df[self.time])
-                freq = 'y'
-                periods = 1
+        self.time = df.columns[-2]
+
+        first = df[self.time].iat[0]
+        marker = next((c for c in 'MUK' if c in first), 'Y')
+        self.time, parse, freq, periods = self._TIME_SPEC[(self.language, marker)]
 
         #the input to `Prophet` is always a `pandas.DataFrame` object, and it must contain two columns: `ds` and `y`:
-        df_ret.columns = ['ds', 'y']
+        df_ret = pd.DataFrame({'ds': parse(df[self.time]), 'y': df[val_col].to_numpy()})
 
         return [df_ret, freq, periods]
\ No newline at end of file